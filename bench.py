@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013 the Institute for Institutional Innovation by Data
+# Driven Design Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE MASSACHUSETTS INSTITUTE OF
+# TECHNOLOGY AND THE INSTITUTE FOR INSTITUTIONAL INNOVATION BY DATA
+# DRIVEN DESIGN INC. BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+# USE OR OTHER DEALINGS IN THE SOFTWARE.
+# #
+# Except as contained in this notice, the names of the Institute for
+# Institutional Innovation by Data Driven Design Inc. shall not be used in
+# advertising or otherwise to promote the sale, use or other dealings
+# in this Software without prior written authorization from the
+# Institute for Institutional Innovation by Data Driven Design Inc.
+
+"""
+Microbenchmarks for the per-request overhead of the library. None of these
+talk to a server.
+
+    python bench.py
+"""
+
+__author__ = 'Tomas Neme'
+__maintainer__ = 'Tomas Neme'
+__email__ = 'lacrymology@gmail.com'
+
+from datetime import timedelta
+import json
+import multiprocessing
+import time
+import timeit
+
+import requests
+
+from mitreid.Api import Api
+from mitreid.tracing import Tracer
+from mitreid import validation
+
+HOST = 'logrus.idhypercubed.org'
+HOSTS = [HOST, 'logrus2.idhypercubed.org']
+TOKEN = 'benchmark-token'
+NUMBER = 100000
+
+
+def _unprepared_endpoint(cls, endpoint, fmt=None):
+    """
+    _get_endpoint as it was before the URL templates were precomputed
+    """
+    if fmt is None:
+        fmt = {}
+    method, endpoint = cls._ENDPOINTS[endpoint]
+    f = getattr(requests, method.lower())
+    return f, "{}{}{}".format(cls._api.root,
+                              cls._API_ROOT,
+                              endpoint).format(**fmt)
+
+
+def _unprepared_headers(cls, extra=None):
+    """
+    _get_headers as it was before the base headers were cached
+    """
+    if extra is None:
+        extra = {}
+    headers = {'Authorization': 'Bearer ' + cls._api.token.accessToken}
+    headers.update(extra)
+    return headers
+
+
+def _report(name, before, after):
+    print('{:<24} {:>8.3f}us {:>8.3f}us {:>6.2f}x'.format(
+        name, before * 1e6 / NUMBER, after * 1e6 / NUMBER, before / after))
+
+
+def bench_request_overhead():
+    api = Api(TOKEN, HOST)
+    Token, Client = api.Token, api.Client
+
+    print('{:<24} {:>10} {:>10} {:>7}'.format('', 'before', 'after', ''))
+    _report('Token read endpoint',
+            timeit.timeit(lambda: _unprepared_endpoint(Token, 'read'),
+                          number=NUMBER),
+            timeit.timeit(lambda: Token._get_endpoint('read'),
+                          number=NUMBER))
+    _report('Client read endpoint',
+            timeit.timeit(lambda: _unprepared_endpoint(Client, 'read',
+                                                       {'id': 42}),
+                          number=NUMBER),
+            timeit.timeit(lambda: Client._get_endpoint('read', {'id': 42}),
+                          number=NUMBER))
+    _report('headers',
+            timeit.timeit(lambda: _unprepared_headers(Client),
+                          number=NUMBER),
+            timeit.timeit(lambda: Client._get_headers(),
+                          number=NUMBER))
+    extra = {'Content-Type': 'application/json'}
+    _report('JSON headers',
+            timeit.timeit(lambda: _unprepared_headers(Client, extra),
+                          number=NUMBER),
+            timeit.timeit(lambda: Client._get_headers(json=True),
+                          number=NUMBER))
+    # Token.read sends the token being read instead of the Api's one
+    other = 'another-token'
+    _report('Token read headers',
+            timeit.timeit(lambda: _unprepared_headers(Token, {
+                'Authorization': 'Bearer ' + other}),
+                          number=NUMBER),
+            timeit.timeit(lambda: Token._token_headers(other),
+                          number=NUMBER))
+
+
+class _StubResponse(object):
+    """
+    Canned answer to a token read, so bench_token_read times the library
+    and not the network
+    """
+    status_code = 200
+    elapsed = timedelta(milliseconds=5)
+    content = json.dumps({
+        'accessToken': TOKEN,
+        'accessTokenExpiresAt': '2030-01-01T00:00:00+0000',
+        'clientId': 'client',
+        'authorizingUser': 'user',
+        'authorizedScopesSet': ['openid', 'email'],
+        'authorizedPersonaSet': ['Home'],
+    })
+
+    def raise_for_status(self):
+        pass
+
+
+def bench_token_read(number=NUMBER // 10):
+    """
+    Times Token.read end to end, with requests.get stubbed out
+    """
+    response = _StubResponse()
+    get = requests.get
+    requests.get = lambda url, **kwargs: response
+    try:
+        for name, api in (('Token.read', Api(TOKEN, HOST)),
+                          ('Token.read traced',
+                           Api(TOKEN, HOST, tracer=Tracer())),
+                          ('Token.read 2 hosts', Api(TOKEN, HOSTS))):
+            t = timeit.timeit(lambda: api.Token.read('another-token'),
+                              number=number)
+            print('{:<24} {:>8.3f}us'.format(name, t * 1e6 / number))
+    finally:
+        requests.get = get
+
+
+def bench_validate_many(count=2000):
+    """
+    Validates `count` RS256 tokens inline and with pools of worker
+    processes. Needs PyJWT and cryptography
+    """
+    if validation.jwt is None:
+        print('validate_many: PyJWT is not installed')
+        return
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048,
+                                   backend=default_backend())
+    public = key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo)
+    exp = int(time.time()) + 3600
+    tokens = [validation.jwt.encode({'sub': 'user%d' % i, 'exp': exp}, key,
+                                    algorithm='RS256')
+              for i in range(count)]
+
+    cpus = multiprocessing.cpu_count()
+    for processes in sorted(set([0, 1, 2, cpus])):
+        # a new validator each time, so nothing is cached
+        with validation.TokenValidator(public,
+                                       processes=processes) as validator:
+            if processes:
+                # the pool is started once per validator, don't time it
+                validator._get_pool()
+            start = timeit.default_timer()
+            validator.validate_many(tokens)
+            t = timeit.default_timer() - start
+        print('{:<24} {:>8.0f} tokens/s ({} CPUs)'.format(
+            'validate_many %d procs' % processes, count / t, cpus))
+
+
+def bench_clients_list(count=50000):
+    """
+    Builds `count` Clients from list-like server data, eagerly and lazily,
+    and reads the fields most clients_list consumers use
+    """
+    api = Api(TOKEN, HOST)
+    Client = api.Client
+    fields = ['id', 'clientId', 'scope', 'redirectUris']
+    clients_json = []
+    for i in range(count):
+        cj = dict(Client._DEFAULTS)
+        cj.update({'id': i, 'clientId': 'client-%d' % i,
+                   'clientSecret': 'secret', 'scope': ['openid', 'email'],
+                   'redirectUris': ['https://example.com/%d' % i]})
+        clients_json.append(cj)
+
+    def build(factory):
+        start = timeit.default_timer()
+        for c in [factory(cj) for cj in clients_json]:
+            c.id, c.clientId, c.scope, c.redirectUris
+        return timeit.default_timer() - start
+
+    eager = build(Client)
+    print('{:<24} {:>8.3f}s'.format('%d eager Clients' % count, eager))
+    for name, factory in (('lazy', Client._lazy),
+                          ('projected',
+                           lambda cj: Client._lazy(cj, fields=fields))):
+        t = build(factory)
+        print('{:<24} {:>8.3f}s {:>6.2f}x'.format(
+            '%d %s Clients' % (count, name), t, eager / t))
+
+
+if __name__ == '__main__':
+    bench_request_overhead()
+    bench_token_read()
+    bench_validate_many()
+    bench_clients_list()
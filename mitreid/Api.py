@@ -42,8 +42,20 @@ __author__ = 'Tomas Neme'
 __maintainer__ = 'Tomas Neme'
 __email__ = 'lacrymology@gmail.com'
 
+import atexit
+import weakref
+
+from mitreid.balancer import HostPool
+from mitreid.cache import ApiCache, DEFAULT_MAX_ENTRIES, DEFAULT_TTL
 from mitreid.Client import client_factory
 from mitreid.Token import token_factory
+from mitreid.tracing import NULL_TRACER
+
+
+def _save_at_exit(cache_ref):
+    cache = cache_ref()
+    if cache is not None:
+        cache.save()
 
 
 class Api(object):
@@ -56,17 +68,84 @@ class Api(object):
         # 'offline_access',
     ]
     defaultPersonas = ['Home', 'Work', 'Mobile']
-    def __init__(self, accessToken, oidcHost):
+    def __init__(self, accessToken, oidcHost, cache_ttl=None,
+                 cache_file=None, cache_save_interval=None, validator=None,
+                 tracer=None, cache_max_entries=DEFAULT_MAX_ENTRIES):
         """
         `accessToken` is an accessToken string that identifies the requesting
         user
+
+        `oidcHost` is the OIDC host, a list of hosts running the same server
+        to spread the requests across, or a mitreid.balancer.HostPool. Hosts
+        are reached over https unless they include a scheme, like
+        'http://localhost:8080'
+
+        If `cache_ttl` or `cache_file` are given, Token and Client reads are
+        cached for `cache_ttl` seconds (mitreid.cache.DEFAULT_TTL by default).
+        With a `cache_file`, the cache is loaded from it now and saved to it
+        when the process exits (if the Api is still around by then), and
+        every `cache_save_interval` seconds if given. At most
+        `cache_max_entries` responses are kept. See mitreid.cache.ApiCache
+
+        `validator` is a mitreid.validation.TokenValidator used by
+        Token.validate to check tokens locally
+
+        `tracer` is a mitreid.tracing.Tracer that records the timings of the
+        Api calls
         """
-        self.oidcHost = oidcHost
-        self.root = 'https://{}'.format(self.oidcHost)
+        self._set_hosts(oidcHost)
+        self.validator = validator
+        self.tracer = tracer or NULL_TRACER
+        self.cache = None
+        if cache_ttl is not None or cache_file is not None:
+            self.cache = ApiCache(ttl=(DEFAULT_TTL if cache_ttl is None
+                                       else cache_ttl),
+                                  path=cache_file,
+                                  host=self._cache_host(),
+                                  save_interval=cache_save_interval,
+                                  max_entries=cache_max_entries)
+            if cache_file is not None:
+                # a weak reference, so the cache doesn't live as long as the
+                # process
+                atexit.register(_save_at_exit, weakref.ref(self.cache))
         self.Token = token_factory(self)
         self.token = self.Token(accessToken=accessToken)
         self.Client = client_factory(self)
 
+    def _set_hosts(self, oidcHost):
+        self._oidcHost = oidcHost
+        if isinstance(oidcHost, HostPool):
+            self.hosts = oidcHost
+        else:
+            self.hosts = HostPool(oidcHost)
+        # URL of the first host, for the requests that aren't balanced
+        self.root = self.hosts.hosts[0].root
+
+    def _cache_host(self):
+        return ','.join(host.host for host in self.hosts)
+
+    @property
+    def oidcHost(self):
+        """
+        The OIDC host or hosts. Setting it replaces the HostPool
+        """
+        return self._oidcHost
+
+    @oidcHost.setter
+    def oidcHost(self, oidcHost):
+        self._set_hosts(oidcHost)
+        if self.cache is not None:
+            # nothing cached for the old hosts applies anymore
+            self.cache.clear()
+            self.cache.host = self._cache_host()
+
+    def save_cache(self):
+        """
+        Writes the cache to its file, if it has one
+        """
+        if self.cache is not None and self.cache.path is not None:
+            self.cache.save()
+
     def defaultGrantedScopes(self):
         return self.defaultScopes
 
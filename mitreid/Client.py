@@ -43,11 +43,15 @@ __maintainer__ = 'Tomas Neme'
 __email__ = 'lacrymology@gmail.com'
 
 import json
+import threading
 
 from mitreid.base import BaseApiObject
 from mitreid.exceptions import MitreIdException
-
-JSON_MEDIA_TYPE = 'application/json'
+from mitreid import migration
+from mitreid import registry
+from mitreid.scopes import scope_set
+from mitreid.session import ClientSession
+from mitreid.tracing import traced
 
 def client_factory(api):
     class Client(BaseApiObject):
@@ -104,6 +108,9 @@ def client_factory(api):
 
         _API_ROOT = '/idoic/api/clients'
 
+        # the active ClientSession of each thread, see session()
+        _sessions = threading.local()
+
         _ENDPOINTS = {
             'list':   ('GET',    ''),
             'create': ('POST',   ''),
@@ -129,73 +136,187 @@ def client_factory(api):
                 self.generateSecret = False
 
         @classmethod
-        def clients_list(cls):
-            headers = cls._get_headers()
-            method, endpoint = cls._get_endpoint('list')
-            res = method(endpoint, headers=headers, verify=False)
-            MitreIdException._wrap_requests_response(res)
-            clients_json = json.loads(res.content)
+        def _lazy(cls, attrs, fields=None):
+            # same as in __init__, a server-provided secret must not be
+            # regenerated
+            if attrs.get('clientSecret') and 'generateSecret' not in attrs:
+                # without changing the caller's dictionary
+                attrs = dict(attrs, generateSecret=False)
+            return super(Client, cls)._lazy(attrs, fields=fields)
+
+        @classmethod
+        @traced
+        def clients_list(cls, lazy=False, fields=None):
+            """
+            Returns the list of all Clients in the server
+
+            If `lazy` is True, the Clients keep the server response and only
+            set each attribute the first time it's accessed. `fields` is a
+            list of attribute names to keep, and implies `lazy`. Clients
+            listed with `fields` can't be updated
+            """
+            clients_json = cls._loads(cls._get_content('list', 'clients'))
+            if lazy or fields is not None:
+                return [cls._lazy(cj, fields=fields) for cj in clients_json]
             return [cls(cj) for cj in clients_json]
 
+        @classmethod
+        def _get_content(cls, endpoint, cache_key, fmt=None):
+            """
+            GETs `endpoint` and returns the response content, going through
+            the Api's cache, if any, under `cache_key`
+            """
+            cache = cls._api.cache
+            if cache is not None:
+                content = cache.get(cache_key)
+                if content is not None:
+                    return content
+            res = cls._request(endpoint, fmt, headers=cls._get_headers())
+            if cache is not None:
+                cache.set(cache_key, res.content)
+            return res.content
+
+        def _invalidate_cache(self):
+            """
+            Drops the cached responses this instance's changes make stale
+            """
+            if self._api.cache is not None:
+                self._api.cache.invalidate('clients', 'client:%s' % self.id)
+
+        @property
+        def _session(self):
+            return getattr(self._sessions, 'session', None)
+
+        @classmethod
+        def session(cls, max_workers=4, check_conflicts=True):
+            """
+            Returns a ClientSession for this Api's Clients. Use it as a
+            context manager: inside it, saving existing Clients from the
+            same thread is deferred, and all of them are updated when it
+            exits, leaving the outcome in its `report`:
+
+                with api.Client.session() as session:
+                    session.track(client)
+                    client.add_scopes('phone')
+                    client.save()
+                session.report
+
+            See mitreid.session.ClientSession
+            """
+            return ClientSession(cls, max_workers=max_workers,
+                                 check_conflicts=check_conflicts)
+
+        def _track(self):
+            """
+            Lets the active session, if any, know this instance's state
+            before it's changed
+            """
+            if self.id is not None and self._session is not None:
+                self._session.track(self)
+
+        @classmethod
+        @traced
+        def export_snapshot(cls, path):
+            """
+            Writes every Client in the server to a columnar snapshot file at
+            `path`, which can be read with mitreid.registry.RegistrySnapshot.
+            Returns the number of Clients written
+            """
+            clients = cls.clients_list(fields=registry.FIELDS)
+            return registry.write_snapshot(path, clients)
+
+        @classmethod
+        @traced
+        def export_jsonl(cls, path):
+            """
+            Writes every Client in the server to `path` as JSON lines, which
+            can be loaded into another server with import_jsonl. Returns the
+            number of Clients written
+            """
+            return migration.export_jsonl(cls, path)
+
+        @classmethod
+        def import_jsonl(cls, path, max_workers=4, max_pending=None,
+                         checkpoint=None):
+            """
+            Creates a Client for each line of the JSON-lines file at `path`,
+            `max_workers` at a time, reading the file as it goes. Pass a
+            `checkpoint` file path to be able to resume an interrupted import.
+            Returns a mitreid.migration.ImportReport
+            """
+            return migration.import_jsonl(cls, path, max_workers=max_workers,
+                                          max_pending=max_pending,
+                                          checkpoint=checkpoint)
+
+        @traced
         def create(self):
+            if self._is_partial():
+                raise MitreIdException(
+                    "Can't create a Client listed with only some fields")
             # make sure we don't have an id
             self.id = None
             data = json.dumps(self._todict())
-            headers = self._get_headers(extra={'Content-Type': JSON_MEDIA_TYPE})
-            method, endpoint = self._get_endpoint('create')
-            res = method(endpoint, data=data, headers=headers, verify=False)
-            MitreIdException._wrap_requests_response(res)
-            attrs = json.loads(res.content)
+            res = self._request('create', data=data,
+                                headers=self._get_headers(json=True))
+            attrs = self._loads(res.content)
 
             # update with server-created defaults
             self._fromdict(attrs)
+            self._invalidate_cache()
 
         @classmethod
+        @traced
         def read(cls, id):
             """
             Returns a single Client getting it from the server by id
             """
-            headers = cls._get_headers()
-            method, endpoint = cls._get_endpoint('read', {'id': id})
-            res = method(endpoint, headers=headers, verify=False)
-            MitreIdException._wrap_requests_response(res)
-            attrs = json.loads(res.content)
+            content = cls._get_content('read', 'client:%s' % id, {'id': id})
+            attrs = cls._loads(content)
 
             return cls(attrs)
         get = read
 
+        @traced
         def update(self):
             """
             Updates the server counterpart of this instance with it's current
             attributes
             """
+            if self._is_partial():
+                raise MitreIdException(
+                    "Can't update a Client listed with only some fields")
             data = json.dumps(self._todict())
-            headers = self._get_headers(extra={'Content-Type': JSON_MEDIA_TYPE})
-            method, endpoint = self._get_endpoint('update', {'id': self.id})
-            res = method(endpoint, data=data, headers=headers, verify=False)
-            MitreIdException._wrap_requests_response(res)
+            res = self._request('update', {'id': self.id}, data=data,
+                                headers=self._get_headers(json=True))
 
             # update any fields returned from the server
-            attrs = json.loads(res.content)
+            attrs = self._loads(res.content)
             self._fromdict(attrs)
+            self._invalidate_cache()
 
+        @traced
         def delete(self):
             """
             Deletes the server counterpart of this instance. Does not destroy
             the instance itself, but it removes the id
             """
-            headers = self._get_headers()
-            method, endpoint = self._get_endpoint('delete', {'id': self.id})
-            res = method(endpoint, headers=headers, verify=False)
-            MitreIdException._wrap_requests_response(res)
+            self._request('delete', {'id': self.id},
+                          headers=self._get_headers())
+            self._invalidate_cache()
 
             # remove this instance's id
             self.id = None
 
+        @traced
         def save(self):
             """
             Creates or updates in server from self
+
+            Inside a session, updates are deferred until the session is
+            flushed
             """
+            if self.id is not None and self._session is not None:
+                return self._session.mark(self)
             if self.id is None:
                 return self.create()
             else:
@@ -207,11 +328,8 @@ def client_factory(api):
 
             `scopes` can be either a single scope string, or an iterable
             """
-            if isinstance(scopes, basestring):
-                scopes = [scopes]
-            for scope in scopes:
-                if scope not in self.scope:
-                    self.scope.append(scope)
+            self._track()
+            scope_set(self, 'scope').add(scopes)
 
         def remove_scopes(self, scopes):
             """
@@ -219,15 +337,21 @@ def client_factory(api):
 
             `scopes` can be either a single scope string, or an iterable
             """
-            if isinstance(scopes, basestring):
-                scopes = [scopes]
-            for scope in scopes:
-                if scope in self.scope:
-                    self.scope.remove(scope)
+            self._track()
+            scope_set(self, 'scope').discard(scopes)
+
+        def has_scopes(self, scopes):
+            """
+            True if the Client has all of `scopes`
+
+            `scopes` can be either a single scope string, or an iterable
+            """
+            return scope_set(self, 'scope').issuperset(scopes)
 
         def __repr__(self):
-            return '[Client: %s %s %s]' % (self.id,
-                                           self.clientId,
-                                           self.clientName)
+            return '[Client: %s %s %s]' % (getattr(self, 'id', None),
+                                           getattr(self, 'clientId', None),
+                                           getattr(self, 'clientName', None))
 
+    Client._build_endpoints()
     return Client
@@ -42,13 +42,14 @@ __author__ = 'Tomas Neme'
 __maintainer__ = 'Tomas Neme'
 __email__ = 'lacrymology@gmail.com'
 
-from datetime import datetime
+import calendar
+from datetime import datetime, timedelta
 import json
 
 from mitreid.base import BaseApiObject
 from mitreid.exceptions import MitreIdException
-
-JSON_MEDIA_TYPE = 'application/json'
+from mitreid.scopes import scope_set
+from mitreid.tracing import NULL_TRACER, traced
 
 def token_factory(api):
     class Token(BaseApiObject):
@@ -83,13 +84,22 @@ def token_factory(api):
             super(Token, self).__init__(*args, **kwargs)
             if isinstance(self.accessTokenExpiresAt, basestring):
                 # convert this to date
-                try:
-                    self.accessTokenExpiresAt = datetime.strptime(self.accessTokenExpiresAt, "%Y-%m-%dT%H:%M:%S%z")
-                except:
-                    ts = self.accessTokenExpiresAt.split('+')[0]
-                    self.accessTokenExpiresAt = datetime.strptime(ts, "%Y-%m-%dT%H:%M:%S")
+                tracer = self._api.tracer
+                if tracer is NULL_TRACER:
+                    self._parse_expiration()
+                else:
+                    with tracer.span('strptime'):
+                        self._parse_expiration()
+
+        def _parse_expiration(self):
+            try:
+                self.accessTokenExpiresAt = datetime.strptime(self.accessTokenExpiresAt, "%Y-%m-%dT%H:%M:%S%z")
+            except:
+                ts = self.accessTokenExpiresAt.split('+')[0]
+                self.accessTokenExpiresAt = datetime.strptime(ts, "%Y-%m-%dT%H:%M:%S")
 
         @classmethod
+        @traced
         def create(cls, clientId, grantedScopes=None, grantedPersonas=None):
             """
             Create a new Token on behalf of client `clientId`
@@ -107,15 +117,14 @@ def token_factory(api):
             data = json.dumps({'clientId': clientId,
                                'grantedPersonas': grantedPersonas,
                                'grantedScopes': grantedScopes})
-            headers = cls._get_headers(extra={'Content-Type': JSON_MEDIA_TYPE})
-            method, endpoint = cls._get_endpoint('create')
-            res = method(endpoint, data=data, headers=headers, verify=False)
-            MitreIdException._wrap_requests_response(res)
-            attrs = json.loads(res.content)
+            res = cls._request('create', data=data,
+                               headers=cls._get_headers(json=True))
+            attrs = cls._loads(res.content)
 
             # create with server response
             return cls(attrs)
 
+        @traced
         def save(self):
             """
             If you created a Token by filling in the clientId, grantedScopes and grantedPersonas fields, but
@@ -129,33 +138,109 @@ def token_factory(api):
             self._fromdict(t._todict())
 
         @classmethod
+        @traced
         def read(cls, token):
             """
             Returns a Token instance with the data for `token` loaded from the server
 
             `token` is the accessToken string
+
+            If the Api has a cache, the details are cached until the token
+            expires or the cache's ttl runs out
             """
             if token is None:
                 token = cls._api.token.accessToken
-            headers = cls._get_headers({'Authorization': 'Bearer ' + token})
-            method, endpoint = cls._get_endpoint('read')
-
-            res = method(endpoint, headers=headers, verify=False)
-            MitreIdException._wrap_requests_response(res)
-            attrs = json.loads(res.content)
-            return cls(attrs)
+            cache = cls._api.cache
+            key = 'token:' + token
+            if cache is not None:
+                content = cache.get(key)
+                if content is not None:
+                    return cls(cls._loads(content))
+
+            res = cls._request('read', headers=cls._token_headers(token))
+            attrs = cls._loads(res.content)
+            t = cls(attrs)
+            if cache is not None:
+                cache.set(key, res.content, t._expires_timestamp())
+            return t
         load_details = read
 
+        @classmethod
+        def _token_headers(cls, token):
+            """
+            Returns the headers to make a request as `token`. Only the Api's
+            own token has its headers cached
+            """
+            if token == cls._api.token.accessToken:
+                return cls._get_headers()
+            return {'Authorization': 'Bearer ' + token}
+
+        @classmethod
+        @traced
+        def validate(cls, token=None):
+            """
+            Returns the claims of the signed `token` (the Api's token by
+            default), checked locally by the Api's validator, without asking
+            the server. Raises MitreIdException if it's not valid
+            """
+            if token is None:
+                token = cls._api.token.accessToken
+            return cls._get_validator().validate(token)
+
+        @classmethod
+        @traced
+        def validate_many(cls, tokens):
+            """
+            Returns a list with the claims of each of `tokens`, checked by the
+            Api's validator in its process pool, or a MitreIdException
+            instance for the invalid ones
+            """
+            return cls._get_validator().validate_many(tokens)
+
+        @classmethod
+        def _get_validator(cls):
+            if cls._api.validator is None:
+                raise MitreIdException('The Api has no token validator')
+            return cls._api.validator
+
+        def has_scopes(self, scopes):
+            """
+            True if this Token was authorized all of `scopes`
+
+            `scopes` can be either a single scope string, or an iterable
+            """
+            return scope_set(self, 'authorizedScopesSet').issuperset(scopes)
+
+        def has_personas(self, personas):
+            """
+            True if this Token was authorized all of `personas`
+
+            `personas` can be either a single persona string, or an iterable
+            """
+            return scope_set(self, 'authorizedPersonaSet').issuperset(personas)
+
+        def _expires_timestamp(self):
+            """
+            Returns accessTokenExpiresAt in seconds since the epoch, or None.
+            Dates without timezone are taken as UTC
+            """
+            expires = self.accessTokenExpiresAt
+            if not isinstance(expires, datetime):
+                return None
+            offset = expires.utcoffset() or timedelta(0)
+            return calendar.timegm((expires - offset).timetuple())
+
+        @traced
         def delete(self):
             """
             Revokes this Token
             """
             data = json.dumps({'clientId': self.clientId,
                                'clientToken': self.accessToken})
-            headers = self._get_headers(extra={'Content-Type': JSON_MEDIA_TYPE})
-            method, endpoint = self._get_endpoint('delete')
-            res = method(endpoint, data=data, headers=headers, verify=False)
-            MitreIdException._wrap_requests_response(res)
+            self._request('delete', data=data,
+                          headers=self._get_headers(json=True))
+            if self._api.cache is not None:
+                self._api.cache.invalidate('token:' + self.accessToken)
         revoke = delete
 
         def __repr__(self):
@@ -163,4 +248,5 @@ def token_factory(api):
                                             self.accessToken[-10:],
                                             self.clientId)
 
+    Token._build_endpoints()
     return Token
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013 the Institute for Institutional Innovation by Data
+# Driven Design Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE MASSACHUSETTS INSTITUTE OF
+# TECHNOLOGY AND THE INSTITUTE FOR INSTITUTIONAL INNOVATION BY DATA
+# DRIVEN DESIGN INC. BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+# USE OR OTHER DEALINGS IN THE SOFTWARE.
+# #
+# Except as contained in this notice, the names of the Institute for
+# Institutional Innovation by Data Driven Design Inc. shall not be used in
+# advertising or otherwise to promote the sale, use or other dealings
+# in this Software without prior written authorization from the
+# Institute for Institutional Innovation by Data Driven Design Inc.
+
+"""
+.. module:: mitreid.balancer
+   :platform: Unix
+   :synopsis: Load balancing and failover across OIDC hosts
+
+.. moduleauthor:: Tomas Neme <lacrymology@gmail.com>
+"""
+
+__author__ = 'Tomas Neme'
+__maintainer__ = 'Tomas Neme'
+__email__ = 'lacrymology@gmail.com'
+
+import threading
+import time
+
+# weight of each new response time in a host's latency average
+LATENCY_DECAY = 0.3
+
+
+class Host(object):
+    """
+    A node of a HostPool, with the load and health the pool has seen on it
+    """
+
+    def __init__(self, host):
+        self.host = host
+        if '://' in host:
+            self.root = host.rstrip('/')
+        else:
+            self.root = 'https://{}'.format(host)
+        self.outstanding = 0
+        # moving average of the response times, None until the first one
+        self.latency = None
+        # consecutive failures
+        self.failures = 0
+        self.ejected_until = 0
+
+    def healthy(self, now=None):
+        return self.ejected_until <= (now or time.time())
+
+    def __repr__(self):
+        return '[Host: %s %d outstanding, latency %s, %d failures]' % (
+            self.host, self.outstanding, self.latency, self.failures)
+
+
+class HostPool(object):
+    """
+    Spreads requests across several hosts running the same server.
+
+    Each request goes to the healthy host with the lowest expected wait: its
+    average response time weighted by the requests it has outstanding.
+
+    Health is checked passively: a host that fails `max_failures` requests in
+    a row (connection errors or 502, 503 and 504 responses, see
+    BaseApiObject._request) is ejected for `cooldown` seconds. Once the
+    cooldown is over it gets requests again, and a single failure ejects it
+    again until it answers successfully. If every host is ejected, the one
+    whose cooldown ends first is used anyway.
+
+    Apis with a single host send their requests straight to it, so its load
+    and health aren't tracked
+    """
+
+    def __init__(self, hosts, cooldown=30, max_failures=3):
+        if isinstance(hosts, basestring):
+            hosts = [hosts]
+        if not hosts:
+            raise ValueError('A HostPool needs at least one host')
+        self.hosts = [Host(host) for host in hosts]
+        self.cooldown = cooldown
+        self.max_failures = max_failures
+        self._lock = threading.Lock()
+        # rotates the order in which equally loaded hosts are picked
+        self._next = 0
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def __iter__(self):
+        return iter(self.hosts)
+
+    def acquire(self, exclude=()):
+        """
+        Picks a host, other than the ones in `exclude`, for a request and
+        counts the request as outstanding on it. The request must be
+        finished with release()
+        """
+        now = time.time()
+        with self._lock:
+            count = len(self.hosts)
+            start = self._next
+            self._next = (start + 1) % count
+            # hosts that haven't answered yet are assumed to be as fast as
+            # the fastest one, so they're tried but their load still counts
+            latencies = [h.latency for h in self.hosts
+                         if h.latency is not None]
+            default = min(latencies) if latencies else 0
+            best = None
+            best_score = None
+            for i in xrange(count):
+                host = self.hosts[(start + i) % count]
+                if host in exclude:
+                    continue
+                if host.healthy(now):
+                    latency = default if host.latency is None else host.latency
+                    score = (0, (host.outstanding + 1) * latency,
+                             host.outstanding)
+                else:
+                    score = (1, host.ejected_until, host.outstanding)
+                if best is None or score < best_score:
+                    best, best_score = host, score
+            if best is None:
+                raise ValueError('No hosts left to try')
+            best.outstanding += 1
+            return best
+
+    def release(self, host, elapsed=None, ok=True):
+        """
+        Finishes a request made to `host`, which took `elapsed` seconds and
+        succeeded unless `ok` is False
+        """
+        with self._lock:
+            host.outstanding -= 1
+            if ok:
+                host.failures = 0
+                host.ejected_until = 0
+                if elapsed is not None:
+                    if host.latency is None:
+                        host.latency = elapsed
+                    else:
+                        host.latency += LATENCY_DECAY * (elapsed -
+                                                         host.latency)
+            else:
+                host.failures += 1
+                if host.failures >= self.max_failures:
+                    host.ejected_until = time.time() + self.cooldown
+
+    def healthy(self):
+        """
+        Returns the hosts that aren't ejected
+        """
+        now = time.time()
+        return [host for host in self.hosts if host.healthy(now)]
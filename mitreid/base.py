@@ -43,8 +43,20 @@ __maintainer__ = 'Tomas Neme'
 __email__ = 'lacrymology@gmail.com'
 
 import copy
+import json
 import requests
 
+from mitreid.exceptions import MitreIdException
+from mitreid.tracing import NULL_TRACER
+
+JSON_MEDIA_TYPE = 'application/json'
+# requests that can be retried on another host after a failure
+IDEMPOTENT_METHODS = frozenset(['get', 'put', 'delete'])
+# responses that mean the host, rather than the request, is at fault. Other
+# errors, like a 500 for a request the server can't handle, would fail on
+# every host
+HOST_ERROR_STATUSES = frozenset([502, 503, 504])
+
 class BaseApiObject(object):
     """
     * _DEFAULTS is a dictionary are the default values for the subclass. It's
@@ -60,6 +72,10 @@ class BaseApiObject(object):
     _DEFAULTS = {}
     _API_ROOT = ''
     _ENDPOINTS = {}
+    # filled in by _build_endpoints: {action: (method, path, templated)}
+    _endpoints = {}
+    # filled in by _get_headers: (accessToken, headers, json headers)
+    _headers = (None, None, None)
 
     def __init__(self, attrs=None, **kwargs):
         """
@@ -68,12 +84,60 @@ class BaseApiObject(object):
 
         Keyword arguments take precedence before the attrs dictionary
         """
-        d = copy.deepcopy(self._DEFAULTS)
+        tracer = self._api.tracer
+        if tracer is NULL_TRACER:
+            d = copy.deepcopy(self._DEFAULTS)
+        else:
+            with tracer.span('deepcopy'):
+                d = copy.deepcopy(self._DEFAULTS)
         if attrs:
             d.update(attrs)
         d.update(kwargs)
 
-        self._fromdict(d)
+        if tracer is NULL_TRACER:
+            self._fromdict(d)
+        else:
+            with tracer.span('fromdict'):
+                self._fromdict(d)
+
+    @classmethod
+    def _lazy(cls, attrs, fields=None):
+        """
+        Builds an instance that keeps `attrs` (usually a parsed server
+        response) as is and only sets each attribute the first time it's
+        accessed, skipping the defaults copy and the setattr of every field.
+
+        If `fields` is given, only those attributes are kept, and every other
+        one raises AttributeError instead of falling back to its default
+        """
+        obj = cls.__new__(cls)
+        if fields is not None:
+            fields = frozenset(fields)
+            attrs = dict((k, attrs[k]) for k in fields if k in attrs)
+        obj._raw = attrs
+        obj._fields = fields
+        return obj
+
+    def __getattr__(self, name):
+        # only called for attributes that haven't been set, which for lazy
+        # instances means the ones that haven't been materialised yet
+        raw = self.__dict__.get('_raw')
+        if raw is None or name.startswith('_'):
+            raise AttributeError(name)
+        if name in raw:
+            value = raw[name]
+        elif self._fields is None and name in self._DEFAULTS:
+            value = copy.deepcopy(self._DEFAULTS[name])
+        else:
+            raise AttributeError(name)
+        setattr(self, name, value)
+        return value
+
+    def _is_partial(self):
+        """
+        True if this instance was built with only a subset of its fields
+        """
+        return self.__dict__.get('_fields') is not None
 
     def _todict(self, attributes_list=None):
         if attributes_list is None:
@@ -91,20 +155,123 @@ class BaseApiObject(object):
             setattr(self, k, v)
 
     @classmethod
-    def _get_endpoint(cls, endpoint, fmt=None):
-        if fmt is None:
-            fmt = {}
-        method, endpoint = cls._ENDPOINTS[endpoint]
-        f = getattr(requests, method.lower())
-        return f, "{}{}{}".format(cls._api.root, # https://example.com
-                                  cls._API_ROOT, # /path/to/(clients|tokenapi)
-                                  endpoint       # /{id}
-                                  ).format(**fmt)
+    def _build_endpoints(cls):
+        """
+        Precomputes the path template for every action in _ENDPOINTS, relative
+        to the host, so _get_endpoint doesn't have to rebuild the strings on
+        each request
+        """
+        endpoints = {}
+        for action, (method, endpoint) in cls._ENDPOINTS.items():
+            path = "{}{}".format(cls._API_ROOT, # /path/to/(clients|tokenapi)
+                                 endpoint       # /{id}
+                                 )
+            # only paths with placeholders need to be formatted per call
+            endpoints[action] = (method.lower(), path, '{' in path)
+        cls._endpoints = endpoints
 
     @classmethod
-    def _get_headers(cls, extra=None):
-        if extra is None:
-            extra = {}
-        headers = {'Authorization': 'Bearer ' + cls._api.token.accessToken}
+    def _get_endpoint(cls, endpoint, fmt=None, root=None):
+        """
+        Returns the requests function and URL for `endpoint`, on the host at
+        `root` (the Api's first host by default)
+        """
+        method, path, templated = cls._endpoints[endpoint]
+        f = getattr(requests, method)
+        if templated:
+            path = path.format(**(fmt or {}))
+        if root is None:
+            root = cls._api.root
+        return f, root + path
+
+    @classmethod
+    def _request(cls, action, fmt=None, **kwargs):
+        """
+        Makes the request for `action`, passing `kwargs` to requests, and
+        returns the response. Raises MitreIdException if it failed
+
+        The request goes to a host picked by the Api's HostPool. If the host
+        can't be reached or answers with a 502, 503 or 504, idempotent
+        requests are retried on the other hosts. With a single host there's
+        nothing to pick, so the pool isn't used
+        """
+        pool = cls._api.hosts
+        if len(pool) == 1:
+            method, url = cls._get_endpoint(action, fmt)
+            res = cls._send(method, url, kwargs)
+            MitreIdException._wrap_requests_response(res)
+            return res
+        method, path = cls._get_endpoint(action, fmt, root='')
+        if cls._endpoints[action][0] in IDEMPOTENT_METHODS:
+            attempts = len(pool)
+        else:
+            attempts = 1
+        tried = []
+        for attempt in xrange(attempts):
+            last = attempt == attempts - 1
+            host = pool.acquire(exclude=tried)
+            tried.append(host)
+            url = host.root + path
+            try:
+                res = cls._send(method, url, kwargs)
+            except requests.RequestException:
+                pool.release(host, ok=False)
+                if last:
+                    raise
+                continue
+            except Exception:
+                # not the host's fault
+                pool.release(host)
+                raise
+            ok = res.status_code not in HOST_ERROR_STATUSES
+            # elapsed is the time until the response headers were parsed
+            pool.release(host, res.elapsed.total_seconds(), ok)
+            if ok or last:
+                break
+        MitreIdException._wrap_requests_response(res)
+        return res
+
+    @classmethod
+    def _send(cls, method, url, kwargs):
+        """
+        Sends a single request with the requests function `method`, timing
+        it if the Api is traced
+        """
+        tracer = cls._api.tracer
+        if tracer is NULL_TRACER:
+            return method(url, verify=False, **kwargs)
+        with tracer.span('http', url=url) as span:
+            res = method(url, verify=False, **kwargs)
+            span.set(status=res.status_code,
+                     elapsed=res.elapsed.total_seconds())
+        return res
+
+    @classmethod
+    def _loads(cls, content):
+        tracer = cls._api.tracer
+        if tracer is NULL_TRACER:
+            return json.loads(content)
+        with tracer.span('json', size=len(content)):
+            return json.loads(content)
+
+    @classmethod
+    def _get_headers(cls, extra=None, json=False):
+        """
+        Returns the request headers, with the Authorization header for the
+        Api's token, and a JSON Content-Type if `json` is True. The headers
+        are cached until the token changes, so the returned dictionary must
+        not be modified
+        """
+        accessToken = cls._api.token.accessToken
+        cached = cls._headers
+        if cached[0] != accessToken:
+            headers = {'Authorization': 'Bearer ' + accessToken}
+            json_headers = dict(headers)
+            json_headers['Content-Type'] = JSON_MEDIA_TYPE
+            cached = cls._headers = (accessToken, headers, json_headers)
+        headers = cached[2] if json else cached[1]
+        if not extra:
+            return headers
+        headers = headers.copy()
         headers.update(extra)
         return headers
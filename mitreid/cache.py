@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013 the Institute for Institutional Innovation by Data
+# Driven Design Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE MASSACHUSETTS INSTITUTE OF
+# TECHNOLOGY AND THE INSTITUTE FOR INSTITUTIONAL INNOVATION BY DATA
+# DRIVEN DESIGN INC. BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+# USE OR OTHER DEALINGS IN THE SOFTWARE.
+# #
+# Except as contained in this notice, the names of the Institute for
+# Institutional Innovation by Data Driven Design Inc. shall not be used in
+# advertising or otherwise to promote the sale, use or other dealings
+# in this Software without prior written authorization from the
+# Institute for Institutional Innovation by Data Driven Design Inc.
+
+"""
+.. module:: mitreid.cache
+   :platform: Unix
+   :synopsis: Response cache with on-disk snapshots
+
+.. moduleauthor:: Tomas Neme <lacrymology@gmail.com>
+"""
+
+__author__ = 'Tomas Neme'
+__maintainer__ = 'Tomas Neme'
+__email__ = 'lacrymology@gmail.com'
+
+from collections import OrderedDict
+import json
+import os
+import threading
+import time
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_ENTRIES = 10000
+VERSION = 1
+
+
+class ApiCache(object):
+    """
+    Cache of server responses, kept as the raw response content so every
+    hit builds fresh objects. Each entry expires after `ttl` seconds, or
+    earlier if set with an explicit expiration time. Expired entries are
+    dropped at least once every `ttl` seconds, and at most `max_entries`
+    are kept, dropping the least recently used ones first.
+
+    If `path` is given, save() writes the non-expired entries there and
+    the cache is loaded from it when created, so a restarted process starts
+    warm. Only entries for the same `host` are loaded. If `save_interval` is
+    given, the cache saves itself when it's changed and it's been at least
+    that many seconds since the last save.
+
+    The file holds access tokens, so it's only readable by its owner
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, path=None, host=None,
+                 save_interval=None, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.path = path
+        self.host = host
+        self.save_interval = save_interval
+        self.max_entries = max_entries
+        # key: (expires, content), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._saved_at = self._pruned_at = time.time()
+        self._save_lock = threading.Lock()
+        if path is not None:
+            self.load()
+
+    def get(self, key):
+        """
+        Returns the cached content for `key`, or None if it's missing or
+        expired
+        """
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                return None
+            if entry[0] <= time.time():
+                return None
+            # back to the end, as the most recently used
+            self._entries[key] = entry
+            return entry[1]
+
+    def set(self, key, content, expires=None):
+        """
+        Caches `content` for `key` until `expires` (seconds since the epoch),
+        but never for longer than the cache's ttl
+        """
+        now = time.time()
+        limit = now + self.ttl
+        if expires is None or expires > limit:
+            expires = limit
+        if expires <= now:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, content)
+            if now - self._pruned_at >= self.ttl:
+                self._prune(now)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        self._maybe_save(now)
+
+    def _prune(self, now):
+        """
+        Drops the expired entries. Must be called with the lock held
+        """
+        for key in [k for k, (expires, _) in self._entries.items()
+                    if expires <= now]:
+            del self._entries[key]
+        self._pruned_at = now
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            self._prune(time.time())
+            return len(self._entries)
+
+    def _maybe_save(self, now):
+        if (self.path is not None and self.save_interval is not None and
+                now - self._saved_at >= self.save_interval):
+            self.save()
+
+    def save(self, path=None):
+        """
+        Writes the non-expired entries to `path`, or to the cache's path
+        """
+        path = path or self.path
+        # threads saving at the same time would share the temporary file
+        with self._save_lock:
+            now = time.time()
+            with self._lock:
+                self._prune(now)
+                entries = dict(self._entries)
+            data = json.dumps({'version': VERSION,
+                               'host': self.host,
+                               'entries': entries})
+            # write to a temporary file and rename it, so a process starting
+            # while we're saving never sees half a file
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.rename(tmp, path)
+            self._saved_at = now
+
+    def load(self, path=None):
+        """
+        Adds the non-expired entries saved in `path`, or in the cache's
+        path, if it exists. Returns the number of entries loaded
+        """
+        path = path or self.path
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return 0
+        if data.get('version') != VERSION or data.get('host') != self.host:
+            return 0
+        now = time.time()
+        limit = now + self.ttl
+        # the ones expiring last are the most worth keeping
+        entries = sorted((expires, key, content)
+                         for key, (expires, content)
+                         in data['entries'].items()
+                         if expires > now)
+        entries = entries[-self.max_entries:] if self.max_entries else []
+        with self._lock:
+            for expires, key, content in entries:
+                self._entries.pop(key, None)
+                self._entries[key] = (min(expires, limit), content)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return len(entries)
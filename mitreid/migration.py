@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013 the Institute for Institutional Innovation by Data
+# Driven Design Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE MASSACHUSETTS INSTITUTE OF
+# TECHNOLOGY AND THE INSTITUTE FOR INSTITUTIONAL INNOVATION BY DATA
+# DRIVEN DESIGN INC. BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+# USE OR OTHER DEALINGS IN THE SOFTWARE.
+# #
+# Except as contained in this notice, the names of the Institute for
+# Institutional Innovation by Data Driven Design Inc. shall not be used in
+# advertising or otherwise to promote the sale, use or other dealings
+# in this Software without prior written authorization from the
+# Institute for Institutional Innovation by Data Driven Design Inc.
+
+"""
+.. module:: mitreid.migration
+   :platform: Unix
+   :synopsis: Streaming JSON-lines export and import of Clients
+
+.. moduleauthor:: Tomas Neme <lacrymology@gmail.com>
+"""
+
+__author__ = 'Tomas Neme'
+__maintainer__ = 'Tomas Neme'
+__email__ = 'lacrymology@gmail.com'
+
+from collections import deque
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import sys
+import threading
+
+
+def export_lines(Client):
+    """
+    Yields a JSON line with the _todict() of each Client in the server
+
+    The server API has no paging, so the list response is still read into
+    memory whole. The lines are built one at a time from it
+    """
+    for client in Client.clients_list(lazy=True):
+        yield json.dumps(client._todict(), sort_keys=True) + '\n'
+
+
+def export_jsonl(Client, path):
+    """
+    Writes every Client in the server to `path`, one JSON object per line.
+    Returns the number of Clients written
+    """
+    count = 0
+    with open(path, 'w') as f:
+        for line in export_lines(Client):
+            f.write(line)
+            count += 1
+    return count
+
+
+def _read_lines(path, offset=0):
+    """
+    Yields (start offset, end offset, line) for each non-blank line of the
+    file at `path`, starting at byte `offset`
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            start = offset
+            offset += len(line)
+            if line.strip():
+                yield start, offset, line
+
+
+def read_records(path, offset=0):
+    """
+    Yields (start offset, end offset, record) for each line of the JSON-lines
+    file at `path`, starting at byte `offset`. Blank lines are skipped
+    """
+    for start, end, line in _read_lines(path, offset):
+        yield start, end, json.loads(line.decode('utf-8'))
+
+
+def read_checkpoint(path):
+    """
+    Returns the offset saved in the checkpoint file at `path`, or 0
+    """
+    try:
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def _write_checkpoint(path, offset):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write('%d\n' % offset)
+    os.rename(tmp, path)
+
+
+class ImportReport(object):
+    """
+    Outcome of import_jsonl:
+
+    * created: number of Clients created
+    * failures: (offset, clientId, exception) for the lines whose Client
+      couldn't be created, or that couldn't be decoded (with no clientId).
+      The offset can be used to retry them
+    * offset: offset up to which the file was processed
+    """
+
+    def __init__(self, offset):
+        self.created = 0
+        self.failures = []
+        self.offset = offset
+
+    def __repr__(self):
+        return '[ImportReport: %d created, %d failures, offset %d]' % (
+            self.created, len(self.failures), self.offset)
+
+
+def import_jsonl(Client, path, max_workers=4, max_pending=None,
+                 checkpoint=None, checkpoint_every=100):
+    """
+    Creates a Client for each line of the JSON-lines file at `path`, with
+    `max_workers` requests at a time. The file is read as the creates
+    complete, keeping at most `max_pending` records in memory (four times
+    `max_workers` by default). Lines that aren't valid JSON are reported as
+    failures.
+
+    If `checkpoint` is a file path, the import starts from the offset saved
+    there, and saves its progress every `checkpoint_every` Clients and when
+    it stops, even if it's interrupted, so it can be resumed. The saved
+    offset is the one up to which every line was processed (created or
+    reported as failed), so if the import is interrupted, up to
+    `max_pending` Clients past it may be created again on resume.
+
+    Returns an ImportReport. Errors other than failed creates, like the
+    checkpoint file not being writable, stop the import and are raised
+    """
+    offset = read_checkpoint(checkpoint) if checkpoint else 0
+    report = ImportReport(offset)
+    max_pending = max_pending or 4 * max_workers
+    slots = threading.BoundedSemaphore(max_pending)
+    lock = threading.Lock()
+    # (start, end) of the submitted lines, in file order, and the starts of
+    # the ones that are done, to move the offset forward
+    submitted = deque()
+    done = set()
+    state = {'unsaved': 0}
+    # exc_info of the errors raised in the workers, which stop the import
+    errors = []
+
+    def finished(start, clientId=None, error=None):
+        try:
+            with lock:
+                if error is None:
+                    report.created += 1
+                else:
+                    report.failures.append((start, clientId, error))
+                done.add(start)
+                while submitted and submitted[0][0] in done:
+                    first, report.offset = submitted.popleft()
+                    done.discard(first)
+                state['unsaved'] += 1
+                if checkpoint and state['unsaved'] >= checkpoint_every:
+                    _write_checkpoint(checkpoint, report.offset)
+                    state['unsaved'] = 0
+        finally:
+            slots.release()
+
+    def create(start, record):
+        try:
+            client = Client(record)
+            client.create()
+        except Exception as e:
+            clientId = (record.get('clientId') if isinstance(record, dict)
+                        else None)
+            finished(start, clientId, e)
+        else:
+            finished(start)
+
+    def work(start, record):
+        try:
+            create(start, record)
+        except BaseException:
+            errors.append(sys.exc_info())
+
+    pool = ThreadPool(max_workers)
+    try:
+        for start, end, line in _read_lines(path, offset):
+            # blocks while max_pending creates haven't finished
+            slots.acquire()
+            if errors:
+                slots.release()
+                break
+            with lock:
+                submitted.append((start, end))
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError as e:
+                finished(start, None, e)
+                continue
+            pool.apply_async(work, (start, record))
+    finally:
+        pool.close()
+        pool.join()
+        if checkpoint and not errors:
+            _write_checkpoint(checkpoint, report.offset)
+    if errors:
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+    return report
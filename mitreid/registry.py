@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013 the Institute for Institutional Innovation by Data
+# Driven Design Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE MASSACHUSETTS INSTITUTE OF
+# TECHNOLOGY AND THE INSTITUTE FOR INSTITUTIONAL INNOVATION BY DATA
+# DRIVEN DESIGN INC. BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+# USE OR OTHER DEALINGS IN THE SOFTWARE.
+# #
+# Except as contained in this notice, the names of the Institute for
+# Institutional Innovation by Data Driven Design Inc. shall not be used in
+# advertising or otherwise to promote the sale, use or other dealings
+# in this Software without prior written authorization from the
+# Institute for Institutional Innovation by Data Driven Design Inc.
+
+"""
+.. module:: mitreid.registry
+   :platform: Unix
+   :synopsis: Columnar snapshots of the client registry
+
+.. moduleauthor:: Tomas Neme <lacrymology@gmail.com>
+"""
+
+__author__ = 'Tomas Neme'
+__maintainer__ = 'Tomas Neme'
+__email__ = 'lacrymology@gmail.com'
+
+import mmap
+import struct
+
+from mitreid.exceptions import MitreIdException
+
+# File layout, all little endian:
+#   header: magic, version, rows, columns, string table offset, strings
+#   directory: for each column, kind, name length, name, offset
+#   string table: (strings + 1) uint32 offsets into the utf-8 blob, blob
+#   columns, each aligned to 8 bytes:
+#     INT:  rows int64, NULL_INT for None
+#     BOOL: rows bytes, NULL_BOOL for None
+#     STR:  rows uint32 string table indices, NULL_STR for None
+#     LIST: (rows + 1) uint32 offsets into the uint32 string table indices
+MAGIC = b'MITREIDC'
+VERSION = 1
+_HEADER = struct.Struct('<8sIIIQI')
+_DIRECTORY_ENTRY = struct.Struct('<cH')
+_OFFSET = struct.Struct('<Q')
+
+INT = b'i'
+BOOL = b'b'
+STR = b's'
+LIST = b'l'
+
+NULL_INT = -2 ** 63
+NULL_BOOL = 255
+NULL_STR = 2 ** 32 - 1
+
+# (attribute, kind) of every column in a snapshot
+COLUMNS = [
+    ('id', INT),
+    ('clientId', STR),
+    ('clientName', STR),
+    ('clientDescription', STR),
+    ('applicationType', STR),
+    ('subjectType', STR),
+    ('tokenEndpointAuthMethod', STR),
+    ('scope', LIST),
+    ('grantTypes', LIST),
+    ('responseTypes', LIST),
+    ('redirectUris', LIST),
+    ('contacts', LIST),
+    ('accessTokenValiditySeconds', INT),
+    ('refreshTokenValiditySeconds', INT),
+    ('idTokenValiditySeconds', INT),
+    ('reuseRefreshToken', BOOL),
+    ('dynamicallyRegistered', BOOL),
+    ('allowIntrospection', BOOL),
+]
+FIELDS = [name for name, kind in COLUMNS]
+
+
+def _align(f):
+    padding = -f.tell() % 8
+    if padding:
+        f.write(b'\0' * padding)
+
+
+def write_snapshot(path, clients):
+    """
+    Writes `clients`, an iterable of Clients or of Client dictionaries, to
+    a columnar snapshot file at `path`. Returns the number of rows written
+    """
+    strings = {}
+    values = dict((name, []) for name in FIELDS)
+
+    def intern(s):
+        try:
+            return strings[s]
+        except KeyError:
+            strings[s] = len(strings)
+            return strings[s]
+
+    rows = 0
+    for client in clients:
+        if not isinstance(client, dict):
+            client = client._todict(FIELDS)
+        for name, kind in COLUMNS:
+            v = client.get(name)
+            if kind == INT:
+                v = NULL_INT if v is None else int(v)
+            elif kind == BOOL:
+                v = NULL_BOOL if v is None else int(bool(v))
+            elif kind == STR:
+                v = NULL_STR if v is None else intern(v)
+            else:
+                v = [intern(s) for s in v or ()]
+            values[name].append(v)
+        rows += 1
+
+    blobs = [None] * len(strings)
+    for s, i in strings.items():
+        blobs[i] = s.encode('utf-8')
+
+    with open(path, 'wb') as f:
+        f.write(b'\0' * _HEADER.size)
+        offset_positions = {}
+        for name, kind in COLUMNS:
+            encoded = name.encode('utf-8')
+            f.write(_DIRECTORY_ENTRY.pack(kind, len(encoded)))
+            f.write(encoded)
+            offset_positions[name] = f.tell()
+            f.write(_OFFSET.pack(0))
+
+        _align(f)
+        strings_offset = f.tell()
+        offsets = [0]
+        for blob in blobs:
+            offsets.append(offsets[-1] + len(blob))
+        f.write(struct.pack('<%dI' % len(offsets), *offsets))
+        f.write(b''.join(blobs))
+
+        column_offsets = {}
+        for name, kind in COLUMNS:
+            _align(f)
+            column_offsets[name] = f.tell()
+            column = values[name]
+            if kind == INT:
+                f.write(struct.pack('<%dq' % rows, *column))
+            elif kind == BOOL:
+                f.write(struct.pack('<%dB' % rows, *column))
+            elif kind == STR:
+                f.write(struct.pack('<%dI' % rows, *column))
+            else:
+                offsets = [0]
+                for v in column:
+                    offsets.append(offsets[-1] + len(v))
+                f.write(struct.pack('<%dI' % len(offsets), *offsets))
+                flat = [i for v in column for i in v]
+                f.write(struct.pack('<%dI' % len(flat), *flat))
+
+        for name, position in offset_positions.items():
+            f.seek(position)
+            f.write(_OFFSET.pack(column_offsets[name]))
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, VERSION, rows, len(COLUMNS),
+                             strings_offset, len(blobs)))
+    return rows
+
+
+class RegistrySnapshot(object):
+    """
+    Read-only, memory mapped view of a snapshot written by write_snapshot.
+
+    Columns are only decoded when first used. Filters take and return lists
+    of row numbers, so they can be chained, and the aggregates accept them
+    to restrict the rows they look at:
+
+        with RegistrySnapshot(path) as snapshot:
+            rows = snapshot.filter('scope', lambda s: 'phone' in s)
+            rows = snapshot.filter('dynamicallyRegistered', bool, rows)
+            snapshot.count_by('grantTypes', rows)
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        (magic, version, self._rows, columns,
+         self._strings_offset, self._strings_count) = \
+            _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise MitreIdException('%s is not a client registry snapshot'
+                                   % path)
+
+        self._columns = {}
+        self.columns = []
+        pos = _HEADER.size
+        for _ in range(columns):
+            kind, length = _DIRECTORY_ENTRY.unpack_from(self._mm, pos)
+            pos += _DIRECTORY_ENTRY.size
+            name = self._mm[pos:pos + length].decode('utf-8')
+            pos += length
+            offset, = _OFFSET.unpack_from(self._mm, pos)
+            pos += _OFFSET.size
+            self._columns[name] = (kind, offset)
+            self.columns.append(name)
+
+        self._string_offsets = None
+        self._strings = {}
+        self._codes = {}
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._rows
+
+    def _string(self, i):
+        """
+        Returns the string with index `i` in the string table
+        """
+        try:
+            return self._strings[i]
+        except KeyError:
+            pass
+        if self._string_offsets is None:
+            self._string_offsets = struct.unpack_from(
+                '<%dI' % (self._strings_count + 1), self._mm,
+                self._strings_offset)
+        blob = self._strings_offset + 4 * (self._strings_count + 1)
+        start = blob + self._string_offsets[i]
+        end = blob + self._string_offsets[i + 1]
+        s = self._strings[i] = self._mm[start:end].decode('utf-8')
+        return s
+
+    def _column_codes(self, name):
+        """
+        Returns the column as stored: ints, bools as bytes, string indices,
+        or tuples of string indices for lists
+        """
+        try:
+            return self._codes[name]
+        except KeyError:
+            pass
+        try:
+            kind, offset = self._columns[name]
+        except KeyError:
+            raise MitreIdException('No column %r in snapshot' % name)
+        rows = self._rows
+        if kind == INT:
+            codes = struct.unpack_from('<%dq' % rows, self._mm, offset)
+        elif kind == BOOL:
+            codes = struct.unpack_from('<%dB' % rows, self._mm, offset)
+        elif kind == STR:
+            codes = struct.unpack_from('<%dI' % rows, self._mm, offset)
+        else:
+            offsets = struct.unpack_from('<%dI' % (rows + 1), self._mm,
+                                         offset)
+            flat = struct.unpack_from('<%dI' % offsets[-1], self._mm,
+                                      offset + 4 * (rows + 1))
+            codes = [flat[offsets[i]:offsets[i + 1]] for i in range(rows)]
+        self._codes[name] = codes
+        return codes
+
+    def _decoder(self, name):
+        """
+        Returns a function that turns a stored code of column `name` into
+        its value
+        """
+        kind = self._columns[name][0]
+        if kind == INT:
+            return lambda v: None if v == NULL_INT else v
+        elif kind == BOOL:
+            return lambda v: None if v == NULL_BOOL else bool(v)
+        elif kind == STR:
+            return lambda v: None if v == NULL_STR else self._string(v)
+        return lambda v: [self._string(i) for i in v]
+
+    def column(self, name, rows=None):
+        """
+        Returns the values of column `name`, for `rows` or for every row
+        """
+        codes = self._column_codes(name)
+        decode = self._decoder(name)
+        if rows is None:
+            return [decode(v) for v in codes]
+        return [decode(codes[i]) for i in rows]
+
+    def filter(self, name, predicate, rows=None):
+        """
+        Returns the row numbers, out of `rows` or every row, for which
+        `predicate` is true for the value of column `name`.
+
+        For string columns `predicate` is called once per distinct string
+        """
+        codes = self._column_codes(name)
+        decode = self._decoder(name)
+        if rows is None:
+            rows = range(self._rows)
+        if self._columns[name][0] in (STR, BOOL):
+            matches = {}
+            ret = []
+            for i in rows:
+                code = codes[i]
+                try:
+                    match = matches[code]
+                except KeyError:
+                    match = matches[code] = bool(predicate(decode(code)))
+                if match:
+                    ret.append(i)
+            return ret
+        return [i for i in rows if predicate(decode(codes[i]))]
+
+    def count_by(self, name, rows=None):
+        """
+        Returns a dictionary of value: number of rows for column `name`. For
+        list columns, every element of the list is counted
+        """
+        codes = self._column_codes(name)
+        if rows is None:
+            rows = range(self._rows)
+        counts = {}
+        if self._columns[name][0] == LIST:
+            for i in rows:
+                for code in codes[i]:
+                    counts[code] = counts.get(code, 0) + 1
+            return dict((self._string(code), count)
+                        for code, count in counts.items())
+        for i in rows:
+            code = codes[i]
+            counts[code] = counts.get(code, 0) + 1
+        decode = self._decoder(name)
+        return dict((decode(code), count) for code, count in counts.items())
+
+    def sum(self, name, rows=None):
+        """
+        Returns the sum of the non null values of integer column `name`
+        """
+        if self._columns.get(name, (None,))[0] != INT:
+            raise MitreIdException('%r is not an integer column' % name)
+        codes = self._column_codes(name)
+        if rows is None:
+            return sum(v for v in codes if v != NULL_INT)
+        return sum(codes[i] for i in rows if codes[i] != NULL_INT)
+
+    def rows(self, columns=None, rows=None):
+        """
+        Yields a dictionary of `columns` (all by default) for each of `rows`
+        (all by default)
+        """
+        if columns is None:
+            columns = self.columns
+        if rows is None:
+            rows = range(self._rows)
+        decoded = [(name, self._column_codes(name), self._decoder(name))
+                   for name in columns]
+        for i in rows:
+            yield dict((name, decode(codes[i]))
+                       for name, codes, decode in decoded)
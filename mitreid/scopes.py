@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013 the Institute for Institutional Innovation by Data
+# Driven Design Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE MASSACHUSETTS INSTITUTE OF
+# TECHNOLOGY AND THE INSTITUTE FOR INSTITUTIONAL INNOVATION BY DATA
+# DRIVEN DESIGN INC. BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+# USE OR OTHER DEALINGS IN THE SOFTWARE.
+# #
+# Except as contained in this notice, the names of the Institute for
+# Institutional Innovation by Data Driven Design Inc. shall not be used in
+# advertising or otherwise to promote the sale, use or other dealings
+# in this Software without prior written authorization from the
+# Institute for Institutional Innovation by Data Driven Design Inc.
+
+"""
+.. module:: mitreid.scopes
+   :platform: Unix
+   :synopsis: Scope and persona sets backed by bitmasks
+
+.. moduleauthor:: Tomas Neme <lacrymology@gmail.com>
+"""
+
+__author__ = 'Tomas Neme'
+__maintainer__ = 'Tomas Neme'
+__email__ = 'lacrymology@gmail.com'
+
+import threading
+
+
+class ScopeRegistry(object):
+    """
+    Interns scope and persona names, giving each one a bit, so sets of them
+    can be handled as integer bitmasks
+    """
+
+    def __init__(self):
+        self._bits = {}
+        self._names = []
+        self._lock = threading.Lock()
+
+    def bit(self, name):
+        """
+        Returns the bit for `name`, interning it if it's new
+        """
+        try:
+            return self._bits[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self._bits:
+                self._bits[name] = 1 << len(self._names)
+                self._names.append(name)
+            return self._bits[name]
+
+    def mask(self, names, intern=True):
+        """
+        Returns the bitmask for `names`. If `intern` is False, names that
+        weren't interned yet are left out
+        """
+        if isinstance(names, basestring):
+            names = [names]
+        mask = 0
+        if intern:
+            for name in names:
+                mask |= self.bit(name)
+        else:
+            bits = self._bits
+            for name in names:
+                mask |= bits.get(name, 0)
+        return mask
+
+    def lookup(self, names):
+        """
+        Returns the bitmask for `names`, or None if any of them wasn't
+        interned yet. Never interns anything
+        """
+        if isinstance(names, basestring):
+            names = [names]
+        bits = self._bits
+        mask = 0
+        for name in names:
+            bit = bits.get(name)
+            if bit is None:
+                return None
+            mask |= bit
+        return mask
+
+    def names(self, mask):
+        """
+        Returns the names in `mask`, in interning order
+        """
+        return [name for i, name in enumerate(self._names)
+                if mask >> i & 1]
+
+    def __len__(self):
+        return len(self._names)
+
+
+# registry shared by every ScopeSet
+registry = ScopeRegistry()
+
+
+class ScopeSet(list):
+    """
+    List of scope (or persona) names that also keeps their bitmask, so
+    membership, subset checks and bulk edits don't have to go through the
+    list. It's still a list, so it serializes to JSON like one.
+
+    The mask is computed on first use and dropped whenever the list is
+    modified with the list methods; add() and discard() keep it up to date
+    """
+    _mask = None
+
+    @property
+    def mask(self):
+        if self._mask is None:
+            self._mask = registry.mask(self)
+        return self._mask
+
+    def __contains__(self, name):
+        if not isinstance(name, basestring):
+            return list.__contains__(self, name)
+        return bool(self.mask & registry.mask(name, intern=False))
+
+    def issuperset(self, names):
+        """
+        True if every one of `names` is in the set
+        """
+        # the set's own names are interned with its mask. Names that were
+        # never interned can't be in it, and checks mustn't intern them,
+        # since they may come from untrusted input
+        mask = self.mask
+        required = registry.lookup(names)
+        if required is None:
+            return False
+        return required & mask == required
+
+    def isdisjoint(self, names):
+        return not self.mask & registry.mask(names, intern=False)
+
+    def add(self, names):
+        """
+        Appends the `names` that aren't in the set yet
+        """
+        if isinstance(names, basestring):
+            names = [names]
+        mask = self.mask
+        for name in names:
+            bit = registry.bit(name)
+            if not mask & bit:
+                list.append(self, name)
+                mask |= bit
+        self._mask = mask
+
+    def discard(self, names):
+        """
+        Removes every one of `names` that is in the set
+        """
+        mask = self.mask
+        drop = registry.mask(names, intern=False)
+        if mask & drop:
+            bit = registry.bit
+            list.__setitem__(self, slice(None),
+                             [name for name in self if not bit(name) & drop])
+            self._mask = mask & ~drop
+
+    def _modified(method):
+        def wrapper(self, *args):
+            self._mask = None
+            return method(self, *args)
+        wrapper.__name__ = method.__name__
+        return wrapper
+
+    append = _modified(list.append)
+    extend = _modified(list.extend)
+    insert = _modified(list.insert)
+    remove = _modified(list.remove)
+    pop = _modified(list.pop)
+    __setitem__ = _modified(list.__setitem__)
+    __delitem__ = _modified(list.__delitem__)
+    __iadd__ = _modified(list.__iadd__)
+    __imul__ = _modified(list.__imul__)
+    if hasattr(list, '__setslice__'):
+        __setslice__ = _modified(list.__setslice__)
+        __delslice__ = _modified(list.__delslice__)
+    del _modified
+
+
+def scope_set(obj, attr):
+    """
+    Returns the list in `obj`.`attr` as a ScopeSet, replacing it with one if
+    it's a plain list
+    """
+    value = getattr(obj, attr)
+    if not isinstance(value, ScopeSet):
+        value = ScopeSet(value or ())
+        setattr(obj, attr, value)
+    return value
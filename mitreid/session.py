@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013 the Institute for Institutional Innovation by Data
+# Driven Design Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE MASSACHUSETTS INSTITUTE OF
+# TECHNOLOGY AND THE INSTITUTE FOR INSTITUTIONAL INNOVATION BY DATA
+# DRIVEN DESIGN INC. BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+# USE OR OTHER DEALINGS IN THE SOFTWARE.
+# #
+# Except as contained in this notice, the names of the Institute for
+# Institutional Innovation by Data Driven Design Inc. shall not be used in
+# advertising or otherwise to promote the sale, use or other dealings
+# in this Software without prior written authorization from the
+# Institute for Institutional Innovation by Data Driven Design Inc.
+
+"""
+.. module:: mitreid.session
+   :platform: Unix
+   :synopsis: Write-behind sessions for Client updates
+
+.. moduleauthor:: Tomas Neme <lacrymology@gmail.com>
+"""
+
+__author__ = 'Tomas Neme'
+__maintainer__ = 'Tomas Neme'
+__email__ = 'lacrymology@gmail.com'
+
+from collections import OrderedDict
+import copy
+import json
+from multiprocessing.pool import ThreadPool
+import threading
+
+from mitreid.exceptions import MitreIdException
+
+
+class FlushReport(object):
+    """
+    Outcome of a ClientSession flush:
+
+    * updated: ids of the Clients that were updated
+    * conflicts: (id, fields) for the Clients that weren't updated because
+      someone else changed the same fields in the server
+    * failures: (id, exception) for the Clients whose update failed
+    """
+
+    def __init__(self):
+        self.updated = []
+        self.conflicts = []
+        self.failures = []
+
+    @property
+    def ok(self):
+        return not self.conflicts and not self.failures
+
+    def __repr__(self):
+        return '[FlushReport: %d updated, %d conflicts, %d failures]' % (
+            len(self.updated), len(self.conflicts), len(self.failures))
+
+
+class ClientSession(object):
+    """
+    Unit of work for Client updates. While a session is active in a thread
+    (see Client.session), saving a Client that already exists in the server
+    from that thread only marks it as dirty, and flush() sends one update per
+    dirty Client, at most `max_workers` at a time. Sessions don't affect
+    saves made from other threads.
+
+    The changes of every Client instance saved for the same id are merged:
+    scopes added and removed with add_scopes and remove_scopes are combined,
+    and for other fields the last change wins. A Client's changes are
+    worked out against its state when the session first saw it, which is
+    when it's passed to track(), has its scopes edited, or is first saved.
+    An instance first seen when it's saved may already have been changed,
+    so if other instances were saved for the same id too, its changes can't
+    be told apart and the Client is reported as a failure rather than
+    overwriting them. A Client saved from a single instance is updated with
+    its whole state, like Client.update does.
+
+    With `check_conflicts`, the current server state of each tracked Client
+    is read before updating it, and if someone else changed a field this
+    session changed too, the Client is reported as a conflict and left
+    alone. Otherwise the changes are applied on top of the server state
+    """
+
+    def __init__(self, Client, max_workers=4, check_conflicts=True):
+        self.Client = Client
+        self.max_workers = max_workers
+        self.check_conflicts = check_conflicts
+        # id(client): (client, state when first tracked)
+        self._baselines = {}
+        # id(client) of the instances first seen when they were saved, whose
+        # earlier changes are unknown
+        self._untracked = set()
+        # client id: [client instances, in the order they were saved]
+        self._dirty = OrderedDict()
+        self._lock = threading.Lock()
+        self._previous = None
+        # FlushReport of the flush made when the session exits
+        self.report = None
+
+    def __enter__(self):
+        sessions = self.Client._sessions
+        self._previous = getattr(sessions, 'session', None)
+        sessions.session = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Flushes the session, unless the block raised, in which case the
+        pending changes are discarded and `report` is left as None
+        """
+        self.Client._sessions.session = self._previous
+        if exc_type is None:
+            self.report = self.flush()
+        else:
+            with self._lock:
+                self._dirty.clear()
+
+    def track(self, client):
+        """
+        Remembers the current state of `client`, to tell its changes apart
+        when it's flushed
+        """
+        with self._lock:
+            if id(client) not in self._baselines:
+                self._baselines[id(client)] = (client,
+                                               copy.deepcopy(client._todict()))
+
+    def mark(self, client):
+        """
+        Marks `client` to be updated on the next flush
+        """
+        if client._is_partial():
+            raise MitreIdException(
+                "Can't update a Client listed with only some fields")
+        with self._lock:
+            if id(client) not in self._baselines:
+                self._baselines[id(client)] = (client,
+                                               copy.deepcopy(client._todict()))
+                self._untracked.add(id(client))
+            clients = self._dirty.setdefault(client.id, [])
+            if not any(c is client for c in clients):
+                clients.append(client)
+
+    def __len__(self):
+        return len(self._dirty)
+
+    def flush(self):
+        """
+        Updates every dirty Client and returns a FlushReport
+        """
+        with self._lock:
+            dirty = list(self._dirty.items())
+            self._dirty.clear()
+        report = FlushReport()
+        if not dirty:
+            return report
+        pool = ThreadPool(min(self.max_workers, len(dirty)))
+        try:
+            results = pool.map(self._flush_client, dirty)
+        finally:
+            pool.close()
+            pool.join()
+        for (client_id, clients), (outcome, detail) in zip(dirty, results):
+            if outcome == 'updated':
+                report.updated.append(client_id)
+            elif outcome == 'conflict':
+                report.conflicts.append((client_id, detail))
+            else:
+                report.failures.append((client_id, detail))
+        return report
+
+    def _changes(self, clients):
+        """
+        Returns the merged changed fields of `clients`, the scopes they
+        added and removed, and the state they started from. A single
+        instance that wasn't tracked before it was saved has nothing to
+        compare with, so its whole state is returned as the changes, with no
+        baseline. Raises MitreIdException if such an instance has to be
+        merged with others
+        """
+        untracked = [client for client in clients
+                     if id(client) in self._untracked]
+        if untracked:
+            if len(clients) == 1:
+                return clients[0]._todict(), [], set(), None
+            raise MitreIdException(
+                "Client %s was saved from several instances, and some of them "
+                "weren't tracked before being changed" % clients[0].id)
+        baselines = [self._baselines[id(client)] for client in clients]
+        changes = {}
+        added = []
+        removed = set()
+        for client, (_, base) in zip(clients, baselines):
+            for k, v in client._todict().items():
+                if k == 'scope':
+                    old = set(base.get('scope') or ())
+                    new = v or ()
+                    added.extend(s for s in new
+                                 if s not in old and s not in added)
+                    removed.update(old.difference(new))
+                    removed.difference_update(new)
+                elif base.get(k) != v:
+                    changes[k] = v
+        return changes, added, removed, baselines[0][1]
+
+    def _flush_client(self, item):
+        client_id, clients = item
+        Client = self.Client
+        with Client._api.tracer.trace('ClientSession.update'):
+            try:
+                changes, added, removed, baseline = self._changes(clients)
+                if baseline is None:
+                    state = changes
+                else:
+                    if self.check_conflicts:
+                        res = Client._request('read', {'id': client_id},
+                                              headers=Client._get_headers())
+                        current = Client._loads(res.content)
+                        conflicts = sorted(
+                            k for k, v in changes.items()
+                            if current.get(k) != baseline.get(k) and
+                            current.get(k) != v)
+                        if conflicts:
+                            return 'conflict', conflicts
+                    else:
+                        current = baseline
+                    state = dict(current)
+                    state.update(changes)
+                    scope = [s for s in state.get('scope') or ()
+                             if s not in removed]
+                    scope.extend(s for s in added if s not in scope)
+                    state['scope'] = scope
+                state['id'] = client_id
+
+                res = Client._request('update', {'id': client_id},
+                                      data=json.dumps(state),
+                                      headers=Client._get_headers(json=True))
+                attrs = Client._loads(res.content)
+            except Exception as e:
+                return 'failure', e
+
+        for client in clients:
+            client._fromdict(attrs)
+            client._invalidate_cache()
+            with self._lock:
+                self._baselines[id(client)] = (client,
+                                               copy.deepcopy(client._todict()))
+                self._untracked.discard(id(client))
+        return 'updated', None
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013 the Institute for Institutional Innovation by Data
+# Driven Design Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE MASSACHUSETTS INSTITUTE OF
+# TECHNOLOGY AND THE INSTITUTE FOR INSTITUTIONAL INNOVATION BY DATA
+# DRIVEN DESIGN INC. BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+# USE OR OTHER DEALINGS IN THE SOFTWARE.
+# #
+# Except as contained in this notice, the names of the Institute for
+# Institutional Innovation by Data Driven Design Inc. shall not be used in
+# advertising or otherwise to promote the sale, use or other dealings
+# in this Software without prior written authorization from the
+# Institute for Institutional Innovation by Data Driven Design Inc.
+
+"""
+.. module:: mitreid.tracing
+   :platform: Unix
+   :synopsis: Request tracing
+
+.. moduleauthor:: Tomas Neme <lacrymology@gmail.com>
+"""
+
+__author__ = 'Tomas Neme'
+__maintainer__ = 'Tomas Neme'
+__email__ = 'lacrymology@gmail.com'
+
+from collections import deque
+import functools
+import json
+import os
+import random
+import threading
+import time
+
+
+class Span(object):
+    """
+    A timed phase of a traced call, with the phases nested in it
+    """
+
+    def __init__(self, tracer, name, args, stack):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.children = []
+        self.start = None
+        self.end = None
+        self.thread = threading.current_thread().ident
+        self._stack = stack
+
+    def set(self, **args):
+        """
+        Adds `args` to the span's details
+        """
+        self.args.update(args)
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def __enter__(self):
+        self._stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time.time()
+        if exc_type is not None:
+            self.args['error'] = repr(exc_value)
+        self._stack.pop()
+        if self._stack:
+            self._stack[-1].children.append(self)
+        else:
+            self.tracer.traces.append(self)
+
+    def walk(self):
+        """
+        Yields this span and all the ones nested in it
+        """
+        yield self
+        for child in self.children:
+            for span in child.walk():
+                yield span
+
+
+class _NullSpan(object):
+    """
+    Span that records nothing, for calls that aren't traced
+    """
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+
+class _UnsampledSpan(_NullSpan):
+    """
+    Root of a call that was left out by sampling, so the spans nested in it
+    aren't recorded either
+    """
+
+    def __init__(self, stack):
+        self._stack = stack
+
+    def __enter__(self):
+        self._stack.append(None)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stack.pop()
+
+
+class NullTracer(object):
+    """
+    Tracer for Apis without tracing. Doesn't record anything
+    """
+    traces = ()
+
+    def trace(self, name, **args):
+        return _NULL_SPAN
+
+    def span(self, name, **args):
+        return _NULL_SPAN
+
+NULL_TRACER = NullTracer()
+
+
+class Tracer(object):
+    """
+    Records a tree of timed spans for each public call of an Api, like
+    Client.read or Token.read, with the phases of the call (the HTTP request,
+    JSON decoding, building the objects) nested in it.
+
+    Only a `sample_rate` fraction of the calls are traced, so it can stay
+    enabled in production, and only the last `max_traces` traces are kept.
+    The traces can be written to a file in the Chrome trace event format,
+    which chrome://tracing and Perfetto can open
+    """
+
+    def __init__(self, sample_rate=1.0, max_traces=10000):
+        self.sample_rate = sample_rate
+        self.traces = deque(maxlen=max_traces)
+        self._local = threading.local()
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            stack = self._local.stack = []
+            return stack
+
+    def trace(self, name, **args):
+        """
+        Returns a context manager that times `name`, starting a new trace
+        (if sampled) or nested in the active span of this thread
+        """
+        stack = self._stack()
+        if stack:
+            if stack[-1] is None:
+                return _NULL_SPAN
+        elif random.random() >= self.sample_rate:
+            return _UnsampledSpan(stack)
+        return Span(self, name, args, stack)
+
+    def span(self, name, **args):
+        """
+        Returns a context manager that times `name` nested in the active
+        span of this thread. Outside of a trace it records nothing
+        """
+        stack = self._stack()
+        if not stack or stack[-1] is None:
+            return _NULL_SPAN
+        return Span(self, name, args, stack)
+
+    def clear(self):
+        self.traces.clear()
+
+    def export(self, path, clear=True):
+        """
+        Writes the recorded traces to `path` in the Chrome trace event
+        format, and forgets them unless `clear` is False. Returns the number
+        of traces written
+        """
+        traces = list(self.traces)
+        if clear:
+            for _ in traces:
+                self.traces.popleft()
+        pid = os.getpid()
+        events = []
+        for trace in traces:
+            for span in trace.walk():
+                events.append({'name': span.name,
+                               'ph': 'X',
+                               'ts': span.start * 1e6,
+                               'dur': span.duration * 1e6,
+                               'pid': pid,
+                               'tid': span.thread,
+                               'args': span.args})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f,
+                      default=repr)
+        return len(traces)
+
+
+def traced(method):
+    """
+    Decorator for the public methods of the Api classes, so each call is
+    the root of a span named after its class and method. Calls on Apis
+    without a tracer go straight to the method
+    """
+    # span name for each class the method is called on
+    names = {}
+
+    @functools.wraps(method)
+    def wrapper(obj, *args, **kwargs):
+        cls = obj if isinstance(obj, type) else type(obj)
+        tracer = cls._api.tracer
+        if tracer is NULL_TRACER:
+            return method(obj, *args, **kwargs)
+        try:
+            name = names[cls]
+        except KeyError:
+            name = names[cls] = '{}.{}'.format(cls.__name__, method.__name__)
+        with tracer.trace(name):
+            return method(obj, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013 the Institute for Institutional Innovation by Data
+# Driven Design Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE MASSACHUSETTS INSTITUTE OF
+# TECHNOLOGY AND THE INSTITUTE FOR INSTITUTIONAL INNOVATION BY DATA
+# DRIVEN DESIGN INC. BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+# USE OR OTHER DEALINGS IN THE SOFTWARE.
+# #
+# Except as contained in this notice, the names of the Institute for
+# Institutional Innovation by Data Driven Design Inc. shall not be used in
+# advertising or otherwise to promote the sale, use or other dealings
+# in this Software without prior written authorization from the
+# Institute for Institutional Innovation by Data Driven Design Inc.
+
+"""
+.. module:: mitreid.validation
+   :platform: Unix
+   :synopsis: Local validation of signed access tokens
+
+.. moduleauthor:: Tomas Neme <lacrymology@gmail.com>
+"""
+
+__author__ = 'Tomas Neme'
+__maintainer__ = 'Tomas Neme'
+__email__ = 'lacrymology@gmail.com'
+
+from collections import deque, OrderedDict
+import copy
+import hashlib
+import multiprocessing
+import threading
+import time
+
+try:
+    import jwt
+except ImportError:
+    jwt = None
+
+from mitreid.exceptions import MitreIdException
+
+
+def _verify(token, key, algorithms, audience):
+    """
+    Returns (claims, None) if `token` is valid, or (None, error message)
+    """
+    options = {}
+    if audience is None:
+        options['verify_aud'] = False
+    try:
+        return jwt.decode(token, key, algorithms=list(algorithms),
+                          audience=audience, options=options), None
+    except jwt.InvalidTokenError as e:
+        return None, str(e) or e.__class__.__name__
+
+
+# verification arguments of the pool worker processes, set by _init_worker
+_worker_args = None
+
+
+def _init_worker(key, algorithms, audience):
+    global _worker_args
+    _worker_args = (key, algorithms, audience)
+
+
+def _verify_batch(tokens):
+    return [_verify(token, *_worker_args) for token in tokens]
+
+
+def _batch_tokens(batch):
+    return [token for h, (token, positions) in batch]
+
+
+def _copy_result(result):
+    """
+    Copies cached claims, so callers changing them don't change the cache
+    """
+    if isinstance(result, MitreIdException):
+        return result
+    return copy.deepcopy(result)
+
+
+class TokenValidator(object):
+    """
+    Validates signed JWT access tokens (RS256 by default, as MITREid issues
+    them) against the server's public `key`, without calling the server.
+    Needs PyJWT, with its cryptography extras for RSA.
+
+    Signature checks are CPU bound, so validate_many splits the tokens in
+    batches of `batch_size` and sends them to a pool of `processes` worker
+    processes (one per CPU by default), keeping at most `max_pending` batches
+    queued at a time (twice the processes by default). With `processes=0`,
+    the default on a single CPU, everything is validated in this process.
+
+    Results are cached by token hash, up to `cache_size` tokens, dropping
+    the least recently used ones first: valid tokens until they expire,
+    invalid ones for `error_ttl` seconds
+    """
+
+    def __init__(self, key, algorithms=('RS256',), audience=None,
+                 processes=None, batch_size=64, max_pending=None,
+                 cache_size=10000, error_ttl=60):
+        if jwt is None:
+            raise MitreIdException('Token validation needs PyJWT installed')
+        self.key = key
+        self.algorithms = tuple(algorithms)
+        self.audience = audience
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+            if processes == 1:
+                # a single worker is only slower than validating inline
+                processes = 0
+        self.processes = processes
+        self.batch_size = batch_size
+        self.max_pending = max_pending or 2 * max(processes, 1)
+        self.cache_size = cache_size
+        self.error_ttl = error_ttl
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(
+                self.processes, _init_worker,
+                (self.key, self.algorithms, self.audience))
+        return self._pool
+
+    def close(self):
+        """
+        Stops the worker processes, if they were started
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _hash(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def _cache_get(self, h):
+        with self._cache_lock:
+            try:
+                entry = self._cache.pop(h)
+            except KeyError:
+                return None
+            expires, result = entry
+            if expires is not None and expires <= time.time():
+                return None
+            # back to the end, as the most recently used
+            self._cache[h] = entry
+            return result
+
+    def _cache_set(self, h, claims, error):
+        if claims is not None:
+            result = claims
+            expires = claims.get('exp')
+        else:
+            result = MitreIdException(error)
+            expires = time.time() + self.error_ttl
+        with self._cache_lock:
+            self._cache.pop(h, None)
+            self._cache[h] = (expires, result)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def validate(self, token):
+        """
+        Returns the claims of `token`, or raises MitreIdException if it's not
+        valid. Single tokens are validated in this process
+        """
+        h = self._hash(token)
+        result = self._cache_get(h)
+        if result is None:
+            result = self._cache_set(h, *_verify(token, self.key,
+                                                 self.algorithms,
+                                                 self.audience))
+        if isinstance(result, MitreIdException):
+            raise result
+        return copy.deepcopy(result)
+
+    def validate_many(self, tokens):
+        """
+        Returns a list with the claims of each of `tokens`, or a
+        MitreIdException instance for the invalid ones
+        """
+        results = [None] * len(tokens)
+        # hash: (token, [positions in tokens])
+        todo = OrderedDict()
+        for i, token in enumerate(tokens):
+            h = self._hash(token)
+            result = self._cache_get(h)
+            if result is not None:
+                results[i] = result
+            elif h in todo:
+                todo[h][1].append(i)
+            else:
+                todo[h] = (token, [i])
+
+        todo = list(todo.items())
+        batches = [todo[i:i + self.batch_size]
+                   for i in range(0, len(todo), self.batch_size)]
+
+        def collect(batch, verified):
+            for (h, (token, positions)), (claims, error) in zip(batch,
+                                                                verified):
+                result = self._cache_set(h, claims, error)
+                for i in positions:
+                    results[i] = result
+
+        if self.processes == 0:
+            for batch in batches:
+                collect(batch, [_verify(token, self.key, self.algorithms,
+                                        self.audience)
+                                for token in _batch_tokens(batch)])
+            return [_copy_result(r) for r in results]
+
+        pool = self._get_pool()
+        pending = deque()
+        for batch in batches:
+            if len(pending) >= self.max_pending:
+                done, verified = pending.popleft()
+                collect(done, verified.get())
+            pending.append((batch, pool.apply_async(
+                _verify_batch, (_batch_tokens(batch),))))
+        while pending:
+            done, verified = pending.popleft()
+            collect(done, verified.get())
+        return [_copy_result(r) for r in results]